@@ -1,12 +1,23 @@
 import asyncio
+import logging
 import os
+import queue
+import re
 import sqlite3
-from contextlib import closing
-from urllib.parse import urlparse
-import json
+import threading
+from collections import defaultdict
+from itertools import groupby
+from logging.handlers import QueueHandler, QueueListener
+from operator import itemgetter
 
 import httpx
+import numpy as np
+import orjson
+import websockets
+from cachetools import TTLCache
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from dotenv import load_dotenv
@@ -23,7 +34,26 @@ if not TELEGRAM_BOT_TOKEN:
 
 DB_PATH = "alerts.db"
 
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# Уровень логов воркера задаётся через LOG_LEVEL (DEBUG покажет цену по каждому алерту).
+# Остальные логгеры (aiogram и т.п.) пишут только WARNING и выше.
+LOG_LEVEL = logging.getLevelNamesMapping().get(os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+
+# Записи уходят в очередь, а в stdout их пишет отдельный поток (_log_listener):
+# event loop не ждёт вывода. Поток запускается и останавливается в main().
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s [%(name)s] %(levelname)s %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_output)
+_log_input = QueueHandler(_log_queue)
+_log_input.setFormatter(logging.Formatter("%(message)s"))  # итоговый формат — у _log_output
+logging.basicConfig(level=logging.WARNING, handlers=[_log_input])
+
+logger = logging.getLogger("alerts_worker")
+logger.setLevel(LOG_LEVEL)
+
+# Явная сессия: один пул соединений к Telegram API на всё время работы
+# (закрывается в dp.start_polling при остановке).
+bot = Bot(token=TELEGRAM_BOT_TOKEN, session=AiohttpSession())
 dp = Dispatcher()
 
 main_kb = ReplyKeyboardMarkup(
@@ -36,75 +66,239 @@ main_kb = ReplyKeyboardMarkup(
 
 # ---------- Работа с БД (SQLite) ----------
 
+BUSY_TIMEOUT_MS = 30000
+
+# Направление срабатывания храним числом (колонка direction_code).
+DIRECTION_GE = 0  # цена >= цели
+DIRECTION_LE = 1  # цена <= цели
+DIRECTION_SYMBOLS = {DIRECTION_GE: ">=", DIRECTION_LE: "<="}
+
+# Одно соединение на весь процесс: без открытия/закрытия файла БД на каждый запрос.
+# Хелперы вызываются из пула потоков (asyncio.to_thread), поэтому доступ под локом.
+_DB: sqlite3.Connection | None = None
+_DB_LOCK = threading.Lock()
+
+
+# SQL держим в константах: одинаковая строка на каждый вызов попадает
+# в кэш подготовленных выражений sqlite3 (по умолчанию 128 штук) и не парсится заново.
+SQL_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    market_url TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    target_price REAL NOT NULL,
+    target_price_cents INTEGER NOT NULL DEFAULT 0,
+    direction TEXT NOT NULL DEFAULT '>=',
+    direction_code INTEGER NOT NULL DEFAULT 0,
+    strike INTEGER,
+    side_yes INTEGER NOT NULL DEFAULT 1,
+    slug TEXT NOT NULL DEFAULT '',
+    active INTEGER NOT NULL DEFAULT 1
+)
+"""
+
+# Частичные индексы только по активным алертам: /list и воркер
+# не сканируют всю таблицу вместе с давно сработавшими.
+SQL_CREATE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_alerts_active_user ON alerts(user_id) WHERE active = 1",
+    # Воркер читает активные алерты уже отсортированными по slug — без отдельной сортировки.
+    "CREATE INDEX IF NOT EXISTS idx_alerts_active_slug ON alerts(slug) WHERE active = 1",
+)
+
+SQL_INSERT = """
+INSERT INTO alerts (
+    user_id, market_url, slug, outcome, strike, side_yes,
+    target_price, target_price_cents, direction, direction_code, active
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+"""
+
+SQL_GET_USER = """
+SELECT id, market_url, outcome, target_price_cents, direction_code
+FROM alerts
+WHERE user_id = ? AND active = 1
+ORDER BY id
+"""
+
+SQL_DEACTIVATE = """
+UPDATE alerts
+SET active = 0
+WHERE id = ? AND user_id = ? AND active = 1
+"""
+
+SQL_GET_ACTIVE = """
+SELECT id, user_id, market_url, outcome, target_price_cents, direction_code, strike, side_yes, slug
+FROM alerts
+WHERE active = 1
+ORDER BY slug
+"""
+
+
+def _connect() -> sqlite3.Connection:
+    """
+    Открываем соединение с БД в режиме автокоммита.
+    busy_timeout действует только в рамках соединения, поэтому ставим его здесь.
+    """
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+
 def init_db():
-    """Создаём таблицу alerts, если её ещё нет."""
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS alerts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                market_url TEXT NOT NULL,
-                outcome TEXT NOT NULL,
-                target_price REAL NOT NULL,
-                direction TEXT NOT NULL DEFAULT '>=',
-                active INTEGER NOT NULL DEFAULT 1
-            )
-            """
-        )
-        conn.commit()
+    """Открываем общее соединение и создаём таблицу alerts, если её ещё нет."""
+    global _DB
+    _DB = _connect()
+    # WAL сохраняется в файле БД: воркер читает алерты,
+    # не блокируя запись новых из команд.
+    _DB.execute("PRAGMA journal_mode=WAL")
+    _DB.execute("PRAGMA synchronous=NORMAL")
+    _DB.execute(SQL_CREATE_TABLE)
+    _migrate(_DB)
+    for sql in SQL_CREATE_INDEXES:
+        _DB.execute(sql)
+
+
+def _backfill_target_cents(conn: sqlite3.Connection):
+    """Переводим цену старых строк в центы тем же округлением, что и /add (round())."""
+    rows = conn.execute("SELECT id, target_price FROM alerts").fetchall()
+    conn.executemany(
+        "UPDATE alerts SET target_price_cents = ? WHERE id = ?",
+        [(int(round(target_price * 100)), alert_id) for alert_id, target_price in rows],
+    )
 
 
-def add_alert(user_id: int, market_url: str, outcome: str, target_price: float):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        conn.execute(
-            """
-            INSERT INTO alerts (user_id, market_url, outcome, target_price, direction, active)
-            VALUES (?, ?, ?, ?, '>=', 1)
-            """,
-            (user_id, market_url, outcome, target_price),
+def _backfill_outcomes(conn: sqlite3.Connection):
+    """Разбираем текстовый outcome старых строк в колонки strike / side_yes."""
+    rows = conn.execute("SELECT id, outcome FROM alerts").fetchall()
+    conn.executemany(
+        "UPDATE alerts SET strike = ?, side_yes = ? WHERE id = ?",
+        [(*parse_outcome(outcome), alert_id) for alert_id, outcome in rows],
+    )
+
+
+def _backfill_slugs(conn: sqlite3.Connection):
+    """Заполняем slug события для старых строк (пустая строка, если ссылка не распознана)."""
+    rows = conn.execute("SELECT id, market_url FROM alerts").fetchall()
+    conn.executemany(
+        "UPDATE alerts SET slug = ? WHERE id = ?",
+        [(extract_event_slug(market_url) or "", alert_id) for alert_id, market_url in rows],
+    )
+
+
+# Колонки, появившиеся после первой версии схемы: (имя, объявление, заполнение).
+# Заполнение — SQL или функция от соединения. Старые базы догоняем в init_db().
+SQL_MIGRATIONS = (
+    ("target_price_cents", "INTEGER NOT NULL DEFAULT 0", _backfill_target_cents),
+    (
+        "direction_code",
+        "INTEGER NOT NULL DEFAULT 0",
+        "UPDATE alerts SET direction_code = CASE direction WHEN '<=' THEN 1 ELSE 0 END",
+    ),
+    ("strike", "INTEGER", None),
+    ("side_yes", "INTEGER NOT NULL DEFAULT 1", _backfill_outcomes),
+    ("slug", "TEXT NOT NULL DEFAULT ''", _backfill_slugs),
+)
+
+
+def _migrate(conn: sqlite3.Connection):
+    """
+    Добавляем недостающие колонки из SQL_MIGRATIONS и заполняем их для старых строк,
+    убираем устаревшие индексы.
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(alerts)")}
+    for name, decl, backfill in SQL_MIGRATIONS:
+        if name in columns:
+            continue
+        conn.execute("BEGIN")
+        try:
+            conn.execute(f"ALTER TABLE alerts ADD COLUMN {name} {decl}")
+            if callable(backfill):
+                backfill(conn)
+            elif backfill:
+                conn.execute(backfill)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # idx_alerts_active заменён на idx_alerts_active_slug: пока старый есть,
+    # планировщик выбирает его и сортирует активные алерты по slug отдельным шагом.
+    conn.execute("DROP INDEX IF EXISTS idx_alerts_active")
+
+
+def add_alert(
+    user_id: int,
+    market_url: str,
+    outcome: str,
+    target_cents: int,
+    direction: int = DIRECTION_GE,
+):
+    """
+    Цена хранится в целых центах (1–99), направление — кодом DIRECTION_*.
+    Исход (strike / side_yes) и slug события разбираем один раз здесь,
+    а не на каждом тике воркера.
+    target_price и текстовый direction пишем для совместимости со старыми версиями.
+    """
+    strike, side_yes = parse_outcome(outcome)
+    slug = extract_event_slug(market_url) or ""
+    with _DB_LOCK:
+        _DB.execute(
+            SQL_INSERT,
+            (
+                user_id, market_url, slug, outcome, strike, int(side_yes),
+                target_cents / 100, target_cents, DIRECTION_SYMBOLS[direction], direction,
+            ),
         )
-        conn.commit()
 
 
 def get_user_alerts(user_id: int):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.execute(
-            """
-            SELECT id, market_url, outcome, target_price, direction
-            FROM alerts
-            WHERE user_id = ? AND active = 1
-            ORDER BY id
-            """,
-            (user_id,),
-        )
+    with _DB_LOCK:
+        cur = _DB.execute(SQL_GET_USER, (user_id,))
         return cur.fetchall()
 
 
 def deactivate_alert(user_id: int, alert_id: int) -> bool:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.execute(
-            """
-            UPDATE alerts
-            SET active = 0
-            WHERE id = ? AND user_id = ? AND active = 1
-            """,
-            (alert_id, user_id),
-        )
-        conn.commit()
+    with _DB_LOCK:
+        cur = _DB.execute(SQL_DEACTIVATE, (alert_id, user_id))
         return cur.rowcount > 0
 
 
+def deactivate_alerts(alert_ids: list[int]) -> set[int]:
+    """
+    Деактивируем пачку сработавших алертов одним UPDATE (одна транзакция, один fsync).
+    Возвращаем id, которые были активны и выключены именно этим вызовом:
+    уведомлять нужно только по ним (удалённые через /delete и уже сработавшие отсеются).
+    """
+    if not alert_ids:
+        return set()
+    placeholders = ",".join("?" * len(alert_ids))
+    # SELECT + UPDATE в одной транзакции с блокировкой на запись вместо UPDATE ... RETURNING:
+    # RETURNING есть только с SQLite 3.35, а в Debian 11 / Ubuntu 20.04 стоят 3.34 / 3.31.
+    with _DB_LOCK:
+        _DB.execute("BEGIN IMMEDIATE")
+        try:
+            rows = _DB.execute(
+                f"SELECT id FROM alerts WHERE id IN ({placeholders}) AND active = 1",
+                alert_ids,
+            ).fetchall()
+            claimed = {row[0] for row in rows}
+            if claimed:
+                _DB.execute(
+                    f"UPDATE alerts SET active = 0 WHERE id IN ({placeholders}) AND active = 1",
+                    alert_ids,
+                )
+        except Exception:
+            _DB.execute("ROLLBACK")
+            raise
+        _DB.execute("COMMIT")
+        return claimed
+
+
 def get_all_active_alerts():
     """Все активные алерты для фонового воркера."""
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.execute(
-            """
-            SELECT id, user_id, market_url, outcome, target_price, direction
-            FROM alerts
-            WHERE active = 1
-            """
-        )
+    with _DB_LOCK:
+        cur = _DB.execute(SQL_GET_ACTIVE)
         return cur.fetchall()
 
 
@@ -113,6 +307,18 @@ def get_all_active_alerts():
 GAMMA_BASE = "https://gamma-api.polymarket.com"
 CLOB_BASE = "https://clob.polymarket.com"
 
+# Общий клиент на весь процесс: TCP+TLS рукопожатие с Polymarket делается один раз,
+# дальше соединения переиспользуются, а по HTTP/2 параллельные запросы идут
+# в одном соединении. Открывается/закрывается в main().
+HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+)
+
+
+_SLUG_RE = re.compile(r"polymarket\.com/event/([^/?#]+)", re.IGNORECASE)
+
 
 def extract_event_slug(market_url: str) -> str | None:
     """
@@ -121,25 +327,46 @@ def extract_event_slug(market_url: str) -> str | None:
     - https://polymarket.com/event/bitcoin-above-on-december-12?tid=... -> bitcoin-above-on-december-12
     - https://polymarket.com/event/bitcoin-above-on-december-12/bitcoin-above-78k-on-december-12 -> bitcoin-above-on-december-12
     """
-    try:
-        parsed = urlparse(market_url)
-        parts = parsed.path.strip("/").split("/")
-        if len(parts) >= 2 and parts[0] == "event":
-            return parts[1]
-    except Exception:
-        return None
-    return None
+    m = _SLUG_RE.search(market_url)
+    return m.group(1) if m else None
+
+
+# Метаданные событий (список маркетов, clobTokenIds) почти не меняются,
+# поэтому между тиками воркера держим их в памяти.
+# Истёкшие и лишние записи вытесняются, так что память не растёт со временем.
+EVENT_CACHE_TTL = 300  # секунд
+EVENT_CACHE_SIZE = 1000
+
+_event_cache = TTLCache(maxsize=EVENT_CACHE_SIZE, ttl=EVENT_CACHE_TTL)  # {slug: event}
+
+
+def invalidate_event_cache(slug: str):
+    """Забываем закэшированное событие."""
+    _event_cache.pop(slug, None)
 
 
 async def fetch_event_by_slug(slug: str) -> dict | None:
+    """
+    Событие по slug с кэшем на EVENT_CACHE_TTL секунд.
+    """
+    event = _event_cache.get(slug)
+    if event is not None:
+        return event
+
+    event = await _request_event_by_slug(slug)
+    if event is not None:
+        _event_cache[slug] = event
+    return event
+
+
+async def _request_event_by_slug(slug: str) -> dict | None:
     """
     Тянем описание события по slug из Gamma API.
     """
     url = f"{GAMMA_BASE}/events?slug={slug}"
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        data = resp.json()
+    resp = await HTTP.get(url)
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
 
     # Варианты формата ответа:
     # 1) {"events": [ {...}, ... ]}
@@ -169,33 +396,40 @@ async def strike_exists_in_event(market_url: str, strike: int) -> bool:
     if not event:
         return False
 
-    markets = event.get("markets") or []
-    if not isinstance(markets, list):
-        return False
-
-    for m in markets:
-        title = str(m.get("groupItemTitle") or "")
-        normalized = title.replace(",", "").strip()
-        try:
-            v = int(normalized)
-        except ValueError:
-            continue
-        if v == strike:
-            return True
-
-    return False
+    return strike in _markets_by_strike(event)
 
 
-def pick_token_id_for_outcome(event: dict, outcome_str: str) -> str | None:
+def _markets_by_strike(event: dict) -> dict[int, dict]:
     """
-    Выбираем ERC-1155 token_id из поля clobTokenIds:
-    - ищем нужный market по страйку из outcome_str (например, '82000 YES');
-    - берём clobTokenIds[0] для YES, clobTokenIds[1] для NO.
+    Индекс маркетов события по страйку (groupItemTitle -> int).
+    Строится один раз и хранится в самом событии (оно живёт в кэше),
+    чтобы не разбирать заголовки на каждый алерт.
     """
+    by_strike = event.get("_by_strike")
+    if by_strike is not None:
+        return by_strike
+
+    by_strike = {}
     markets = event.get("markets") or []
-    if not isinstance(markets, list) or not markets:
-        return None
+    if isinstance(markets, list):
+        for m in markets:
+            title = str(m.get("groupItemTitle") or "")
+            normalized = title.replace(",", "").strip()
+            try:
+                v = int(normalized)
+            except ValueError:
+                continue
+            by_strike.setdefault(v, m)
+
+    event["_by_strike"] = by_strike
+    return by_strike
 
+
+def parse_outcome(outcome_str: str) -> tuple[int | None, bool]:
+    """
+    Разбираем исход вида '82000 YES' в (страйк, side_yes).
+    Страйк None, если число не распознано; сторона по умолчанию YES.
+    """
     parts = outcome_str.strip().split()
     strike = None
     side_yes = True  # по умолчанию YES
@@ -208,21 +442,19 @@ def pick_token_id_for_outcome(event: dict, outcome_str: str) -> str | None:
         side_str = parts[1].lower()
         if side_str in ("no", "нет", "нету"):
             side_yes = False
+    return strike, side_yes
 
-    chosen_market = None
 
-    if strike is not None:
-        for m in markets:
-            title = str(m.get("groupItemTitle") or "")
-            normalized = title.replace(",", "").strip()
-            try:
-                v = int(normalized)
-            except ValueError:
-                continue
-            if v == strike:
-                chosen_market = m
-                break
+def pick_token_id_for_outcome(event: dict, strike: int | None, side_yes: bool) -> str | None:
+    """
+    Выбираем ERC-1155 token_id из поля clobTokenIds:
+    - ищем нужный market по страйку (индекс _markets_by_strike);
+    - берём clobTokenIds[0] для YES, clobTokenIds[1] для NO.
+    """
+    if strike is None:
+        return None
 
+    chosen_market = _markets_by_strike(event).get(strike)
     if chosen_market is None:
         return None
 
@@ -231,7 +463,7 @@ def pick_token_id_for_outcome(event: dict, outcome_str: str) -> str | None:
         return None
 
     try:
-        clob_ids = json.loads(clob_token_ids_raw)
+        clob_ids = orjson.loads(clob_token_ids_raw)
     except Exception:
         return None
 
@@ -242,30 +474,51 @@ def pick_token_id_for_outcome(event: dict, outcome_str: str) -> str | None:
     return str(token_id)
 
 
-async def fetch_token_price(token_id: str, side: str = "BUY") -> float | None:
+# Сколько токенов спрашиваем в одном запросе к CLOB /prices.
+PRICES_BATCH_SIZE = 500
+
+
+async def fetch_token_prices(pairs: list[tuple[str, str]]) -> dict[str, float]:
     """
-    Получаем текущую цену токена через CLOB /price.
-    Возвращаем цену в долларах (0.0–1.0).
+    Получаем текущие цены сразу пачки токенов через CLOB /prices.
+    pairs — [(token_id, side), ...]; возвращаем {token_id: цена в долларах (0.0–1.0)}.
+    Токены, по которым цены нет, в результат не попадают.
     """
-    params = {"token_id": token_id, "side": side.upper()}
-    url = f"{CLOB_BASE}/price"
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.get(url, params=params)
-        if resp.status_code != 200:
-            return None
-        data = resp.json()
-    price_str = data.get("price")
-    if price_str is None:
-        return None
-    try:
-        return float(price_str)
-    except ValueError:
-        return None
+    if not pairs:
+        return {}
+
+    body = [{"token_id": token_id, "side": side.upper()} for token_id, side in pairs]
+    resp = await HTTP.post(
+        f"{CLOB_BASE}/prices",
+        content=orjson.dumps(body),
+        headers={"Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+
+    # Формат ответа: {token_id: {"BUY": "0.61", ...}, ...}
+    prices = {}
+    if not isinstance(data, dict):
+        return prices
+    for token_id, side in pairs:
+        by_side = data.get(token_id)
+        if not isinstance(by_side, dict):
+            continue
+        price_str = by_side.get(side.upper())
+        if price_str is None:
+            continue
+        try:
+            prices[token_id] = float(price_str)
+        except ValueError:
+            continue
+    return prices
 
 
 # ---------- FSM-память для /add ----------
 
-user_add_state = {}  # {user_id: {"step": int, "market_url": str, "outcome": str}}
+# Брошенные на полпути диалоги /add сами истекают через час,
+# а общее число хранимых состояний ограничено.
+user_add_state = TTLCache(maxsize=10000, ttl=3600)  # {user_id: {"step": int, "market_url": str, "outcome": str}}
 
 
 # ---------- Команды бота ----------
@@ -295,20 +548,19 @@ async def cmd_add(message: types.Message):
 @dp.message(Command("list"))
 async def cmd_list(message: types.Message):
     user_id = message.from_user.id
-    alerts = get_user_alerts(user_id)
+    alerts = await asyncio.to_thread(get_user_alerts, user_id)
 
     if not alerts:
         await message.answer("У тебя пока нет активных алертов.", reply_markup=main_kb)
         return
 
     lines = []
-    for alert_id, market_url, outcome, target_price, direction in alerts:
-        cents = target_price * 100
+    for alert_id, market_url, outcome, target_cents, direction in alerts:
         lines.append(
             f"ID: {alert_id}\n"
             f"Рынок: {market_url}\n"
             f"Исход: {outcome}\n"
-            f"Условие: цена {direction} {target_price:.4f} ({cents:.1f}c)\n"
+            f"Условие: цена {DIRECTION_SYMBOLS.get(direction, '?')} {target_cents / 100:.2f} ({target_cents}c)\n"
             f"/delete {alert_id}\n"
             f"---"
         )
@@ -331,7 +583,7 @@ async def cmd_delete(message: types.Message):
         await message.answer("ID должен быть числом, пример: `/delete 1`", parse_mode="Markdown")
         return
 
-    ok = deactivate_alert(user_id=user_id, alert_id=alert_id)
+    ok = await asyncio.to_thread(deactivate_alert, user_id=user_id, alert_id=alert_id)
     if ok:
         await message.answer(f"Алерт с ID {alert_id} деактивирован.", reply_markup=main_kb)
     else:
@@ -343,10 +595,11 @@ async def handle_add_flow_or_default(message: types.Message):
     """Обрабатываем шаги диалога /add, если пользователь в состоянии добавления."""
     user_id = message.from_user.id
 
-    if user_id not in user_add_state:
+    # Одним обращением: запись в TTLCache может истечь между проверкой и чтением.
+    state = user_add_state.get(user_id)
+    if state is None:
         return
 
-    state = user_add_state[user_id]
     step = state.get("step", 0)
 
     # Шаг 1: ждём ссылку
@@ -376,24 +629,22 @@ async def handle_add_flow_or_default(message: types.Message):
         try:
             target_price = float(message.text.replace(",", ".").strip())
         except ValueError:
-            await message.answer("Не понял число. Введи цену в формате типа 0.48 или 0.125.")
+            await message.answer("Не понял число. Введи цену в формате типа 0.48 или 0.12.")
             return
 
+        # Сначала диапазон (nan/inf его не проходят), потом перевод в целые центы.
         if not (0.0 < target_price < 1.0):
-            await message.answer("Цена должна быть между 0 и 1, например 0.25 или 0.73.")
+            await message.answer("Цена должна быть между 0.01 и 0.99, например 0.25 или 0.73.")
+            return
+        target_cents = int(round(target_price * 100))
+        if not (1 <= target_cents <= 99):
+            await message.answer("Цена должна быть между 0.01 и 0.99, например 0.25 или 0.73.")
             return
 
         market_url = state["market_url"]
         outcome = state["outcome"]
 
-        parts = outcome.strip().split()
-        strike = None
-        if parts:
-            try:
-                strike = int(parts[0])
-            except ValueError:
-                strike = None
-
+        strike, _ = parse_outcome(outcome)
         if strike is None:
             await message.answer(
                 "Не смог распознать страйк в исходе. "
@@ -403,6 +654,10 @@ async def handle_add_flow_or_default(message: types.Message):
             return
 
         if not await strike_exists_in_event(market_url, strike):
+            # Возможно, маркет только что добавили — при следующей попытке идём в API.
+            slug = extract_event_slug(market_url)
+            if slug:
+                invalidate_event_cache(slug)
             await message.answer(
                 "Похоже, в этом событии нет маркета с таким страйком.\n"
                 "Проверь число в исходе (например, 78000, 82000, 86000) "
@@ -410,16 +665,17 @@ async def handle_add_flow_or_default(message: types.Message):
             )
             return
 
-        add_alert(user_id=user_id, market_url=market_url, outcome=outcome, target_price=target_price)
+        await asyncio.to_thread(
+            add_alert, user_id=user_id, market_url=market_url, outcome=outcome, target_cents=target_cents
+        )
 
         user_add_state.pop(user_id, None)
 
-        cents = target_price * 100
         await message.answer(
             f"Алерт добавлен!\n\n"
             f"Рынок: {market_url}\n"
             f"Исход: {outcome}\n"
-            f"Целевая цена: {target_price:.4f} ({cents:.1f}c)",
+            f"Целевая цена: {target_cents / 100:.2f} ({target_cents}c)",
             reply_markup=main_kb,
         )
         return
@@ -427,87 +683,374 @@ async def handle_add_flow_or_default(message: types.Message):
 
 # ---------- Фоновый воркер ----------
 
+# Сколько запросов к Polymarket держим в полёте одновременно (лимиты API).
+WORKER_CONCURRENCY = 16
+
+# Telegram пускает боту ~30 сообщений в секунду: каждое уведомление держит слот
+# семафора ещё секунду после отправки, так что в секунду уходит не больше NOTIFY_RATE.
+NOTIFY_RATE = 25
+_notify_sem = asyncio.Semaphore(NOTIFY_RATE)
+
+# Полный опрос всех алертов — страховка на случай пропущенных событий websocket.
+POLL_INTERVAL = 60  # секунд
+
+WS_MARKET_URL = "wss://ws-subscriptions-clob.polymarket.com/ws/market"
+WS_DEBOUNCE = 1.0  # секунд: копим изменившиеся токены и проверяем их одной пачкой
+WS_PING_INTERVAL = 10  # секунд: сервер ждёт текстовый PING, иначе рвёт соединение
+WS_RECONNECT_DELAY = 5  # секунд
+# Первый снимок стаканов по всем токенам приходит одним сообщением и легко
+# превышает дефолтный лимит websockets (1 MiB).
+WS_MAX_MESSAGE_SIZE = 32 * 2**20
+
+# Общее состояние воркера опроса и websocket-подписки.
+_watched: dict[str, list[tuple]] = {}  # {token_id: [alert, ...]} — обновляется каждым опросом
+_watched_changed = asyncio.Event()  # набор token_id изменился — нужно обновить подписку
+_notify_tasks: set[asyncio.Task] = set()  # держим ссылки на фоновые рассылки до их завершения
+
+
+async def _limited(sem: asyncio.Semaphore, coro):
+    async with sem:
+        return await coro
+
+
+# Цены сравниваем в целых единицах 0.0001 доллара — мельче любого шага цены Polymarket:
+# текущая цена не округляется до цента (0.615 не считается 62c), и нет ошибок float.
+PRICE_UNITS_PER_CENT = 100
+
+
+def _fired_mask(current: np.ndarray, target: np.ndarray, direction: np.ndarray) -> np.ndarray:
+    """
+    Проверка условий сразу по всем алертам тика (цены в единицах 1/PRICE_UNITS_PER_CENT цента).
+    Возвращает булев массив: True — алерт сработал.
+    """
+    return (
+        ((direction == DIRECTION_GE) & (current >= target))
+        | ((direction == DIRECTION_LE) & (current <= target))
+    )
+
+
+async def _notify_alert(alert, price_usd: float):
+    """Шлём пользователю уведомление о сработавшем алерте."""
+    alert_id, user_id, market_url, outcome, target_cents = alert[:5]
+    text = (
+        f"Сработал алерт #{alert_id}!\n\n"
+        f"Рынок: {market_url}\n"
+        f"Исход: {outcome}\n"
+        f"Целевая цена: {target_cents / 100:.2f} ({target_cents}c)\n"
+        f"Текущая цена: {price_usd:.4f} ({price_usd * 100:.1f}c)\n"
+    )
+    async with _notify_sem:
+        try:
+            try:
+                await bot.send_message(user_id, text)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                await bot.send_message(user_id, text)
+        except Exception as e:
+            logger.error("Ошибка отправки сообщения пользователю %s: %s", user_id, e)
+        await asyncio.sleep(1)
+
+
+async def _notify_alerts(fired: list[tuple[tuple, float]]):
+    """Параллельно шлём уведомления по сработавшим алертам: [(alert, price_usd), ...]."""
+    await asyncio.gather(*(_notify_alert(alert, p) for alert, p in fired))
+
+
+async def _load_alert_tokens(sem: asyncio.Semaphore) -> list[tuple[tuple, str]]:
+    """
+    Берём все активные алерты и для каждого выбираем token_id.
+    События тянем по одному разу на slug (параллельно).
+    """
+    alerts = await asyncio.to_thread(get_all_active_alerts)
+    logger.info("Активных алертов: %d", len(alerts))
+
+    # Много алертов смотрят на одно событие (разные страйки/стороны);
+    # SQL отдаёт их уже отсортированными по slug, так что группы идут подряд.
+    groups = []  # [(slug, [alert, ...])]
+    for slug, group in groupby(alerts, key=itemgetter(8)):
+        if not slug:
+            for alert in group:
+                logger.warning("Не смог вытащить slug из URL %s", alert[2])
+            continue
+        groups.append((slug, list(group)))
+
+    results = await asyncio.gather(
+        *(_limited(sem, fetch_event_by_slug(slug)) for slug, _ in groups),
+        return_exceptions=True,
+    )
+
+    alert_tokens = []  # [(alert, token_id)]
+    for (slug, group), event in zip(groups, results):
+        if isinstance(event, Exception):
+            logger.error("Ошибка при загрузке события %s: %s", slug, event)
+            continue
+        if not event:
+            logger.warning("Не нашёл событие по slug %s", slug)
+            continue
+        for alert in group:
+            strike, side_yes = alert[6], alert[7]
+            token_id = pick_token_id_for_outcome(event, strike, bool(side_yes))
+            if not token_id:
+                logger.warning("Не смог выбрать token_id для outcome '%s'", alert[3])
+                continue
+            alert_tokens.append((alert, token_id))
+    return alert_tokens
+
+
+async def _fetch_prices(token_ids: list[str], sem: asyncio.Semaphore) -> dict[str, float]:
+    """Цены BUY по списку token_id пачками через CLOB /prices."""
+    batches = [
+        [(token_id, "BUY") for token_id in token_ids[k:k + PRICES_BATCH_SIZE]]
+        for k in range(0, len(token_ids), PRICES_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(
+        *(_limited(sem, fetch_token_prices(batch)) for batch in batches),
+        return_exceptions=True,
+    )
+    prices = {}
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            logger.error("Ошибка при получении цен для %d токенов: %s", len(batch), result)
+            continue
+        prices.update(result)
+    return prices
+
+
+def _unwatch(alert_ids: set[int]):
+    """Убираем выключенные алерты из _watched; токены без алертов уходят из подписки."""
+    for token_id in list(_watched):
+        alerts = [alert for alert in _watched[token_id] if alert[0] not in alert_ids]
+        if alerts:
+            _watched[token_id] = alerts
+        else:
+            del _watched[token_id]
+            _watched_changed.set()
+
+
+async def _check_alerts(priced: list[tuple[tuple, float]]) -> set[int]:
+    """
+    Проверяем алерты с известной ценой: [(alert, price_usd), ...].
+    Сработавшие сначала деактивируем одним запросом, затем уведомляем только по тем,
+    что этот запрос действительно выключил: опрос и websocket-подписка могут проверить
+    один алерт одновременно, а пользователь — успеть его удалить. deactivate_alerts
+    выбирает и выключает строки в одной транзакции, так что отдельный лок не нужен.
+    Уведомления уходят фоновой задачей: ограничение частоты отправки (_notify_sem)
+    не задерживает ни опрос, ни чтение websocket.
+    Возвращает id выключенных алертов.
+    """
+    if not priced:
+        return set()
+
+    # Колонки массивами (SoA): одна проверка по всем алертам вместо цикла.
+    n = len(priced)
+    prices_usd = np.fromiter((p for _, p in priced), dtype=np.float64, count=n)
+    current = np.rint(prices_usd * 100 * PRICE_UNITS_PER_CENT).astype(np.int64)
+    target = np.fromiter((a[4] for a, _ in priced), dtype=np.int64, count=n) * PRICE_UNITS_PER_CENT
+    direction = np.fromiter((a[5] for a, _ in priced), dtype=np.int8, count=n)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for alert, p in priced:
+            logger.debug(
+                "alert %s: price=%.4f, target=%dc, dir=%d",
+                alert[0], p, alert[4], alert[5],
+            )
+
+    fired_idx = np.flatnonzero(_fired_mask(current, target, direction)).tolist()
+    if not fired_idx:
+        return set()
+
+    triggered = [priced[k][0][0] for k in fired_idx]
+    try:
+        claimed = await asyncio.to_thread(deactivate_alerts, triggered)
+    except Exception as e:
+        logger.error("Ошибка деактивации алертов %s: %s", triggered, e)
+        return set()
+
+    # Все triggered теперь неактивны (выключены здесь или раньше — в т.ч. через /delete).
+    # Не ждём следующего опроса: иначе каждое изменение цены по этим токенам
+    # снова тянуло бы /prices и делало холостой UPDATE.
+    _unwatch(set(triggered))
+
+    fired = [priced[k] for k in fired_idx if priced[k][0][0] in claimed]
+    if fired:
+        task = asyncio.create_task(_notify_alerts(fired))
+        _notify_tasks.add(task)
+        task.add_done_callback(_notify_tasks.discard)
+    return claimed
+
+
 async def alerts_worker():
     """
-    Цикл:
-    - Берём все активные алерты.
-    - Для каждого:
-      - парсим slug события;
-      - тянем событие из Gamma API и выбираем token_id;
-      - по token_id берём текущую цену из CLOB API;
-      - сравниваем с target_price (0–1 доллара);
-      - при выполнении условия шлём уведомление и деактивируем алерт.
+    Полный опрос раз в POLL_INTERVAL:
+    - Берём все активные алерты и группируем их по slug события.
+    - Каждое событие тянем из Gamma API один раз за тик (параллельно).
+    - Для каждого алерта выбираем token_id; цены всех уникальных
+      token_id берём пачкой из CLOB /prices.
+    - Условия проверяем одной векторной операцией по всем алертам (_check_alerts).
+    - Обновляем набор token_id, на который подписан price_feed_worker.
+    Число одновременных запросов к Polymarket ограничено WORKER_CONCURRENCY.
     """
+    global _watched
+
     await asyncio.sleep(5)
+    sem = asyncio.Semaphore(WORKER_CONCURRENCY)
 
     while True:
-        alerts = get_all_active_alerts()
-        print(f"[alerts_worker] Активных алертов: {len(alerts)}")
+        try:
+            alert_tokens = await _load_alert_tokens(sem)
+            token_ids = list(dict.fromkeys(token_id for _, token_id in alert_tokens))
+            prices = await _fetch_prices(token_ids, sem)
 
-        for alert_id, user_id, market_url, outcome, target_price, direction in alerts:
-            try:
-                slug = extract_event_slug(market_url)
-                if not slug:
-                    print(f"[alerts_worker] Не смог вытащить slug из URL {market_url}")
+            priced = []  # [(alert, price_usd)]
+            for alert, token_id in alert_tokens:
+                price_usd = prices.get(token_id)
+                if price_usd is None:
+                    logger.warning("Не удалось получить цену для token_id %s", token_id)
                     continue
+                priced.append((alert, price_usd))
+            fired = await _check_alerts(priced)
 
-                event = await fetch_event_by_slug(slug)
-                if not event:
-                    print(f"[alerts_worker] Не нашёл событие по slug {slug}")
-                    continue
+            watched = defaultdict(list)
+            for alert, token_id in alert_tokens:
+                if alert[0] not in fired:
+                    watched[token_id].append(alert)
+            if watched.keys() != _watched.keys():
+                _watched_changed.set()
+            _watched = dict(watched)
+        except Exception as e:
+            logger.exception("Ошибка в цикле опроса алертов: %s", e)
 
-                token_id = pick_token_id_for_outcome(event, outcome)
-                if not token_id:
-                    print(f"[alerts_worker] Не смог выбрать token_id для outcome '{outcome}'")
-                    continue
+        await asyncio.sleep(POLL_INTERVAL)
 
-                price_usd = await fetch_token_price(token_id, side="BUY")
-                if price_usd is None:
-                    print(f"[alerts_worker] Не удалось получить цену для token_id {token_id}")
-                    continue
 
-                current_price = price_usd  # 0–1 доллар
-                print(
-                    f"[alerts_worker] alert {alert_id}: price={current_price:.4f}, "
-                    f"target={target_price:.4f}, dir={direction}"
-                )
+def _changed_assets(raw: str | bytes) -> set[str]:
+    """token_id, по которым в сообщении market-канала пришло изменение цены."""
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return set()  # PONG и прочие служебные ответы
+
+    messages = data if isinstance(data, list) else [data]
+    assets = set()
+    for msg in messages:
+        if not isinstance(msg, dict):
+            continue
+        asset_id = msg.get("asset_id")
+        if asset_id:
+            assets.add(str(asset_id))
+        for change in msg.get("price_changes") or []:
+            if isinstance(change, dict) and change.get("asset_id"):
+                assets.add(str(change["asset_id"]))
+    return assets
+
+
+async def _recheck_tokens(token_ids: set[str], sem: asyncio.Semaphore):
+    """Проверяем алерты только по токенам, цена которых изменилась."""
+    prices = await _fetch_prices(list(token_ids), sem)
+    priced = [
+        (alert, prices[token_id])
+        for token_id in token_ids
+        if token_id in prices
+        for alert in _watched.get(token_id, [])
+    ]
+    await _check_alerts(priced)
+
+
+async def _sync_subscription(ws, subscribed: set[str]):
+    """Досылаем в открытое соединение подписку на новые token_id и отписку от ушедших."""
+    _watched_changed.clear()
+    wanted = set(_watched)
+    added = sorted(wanted - subscribed)
+    removed = sorted(subscribed - wanted)
+    if added:
+        await ws.send(orjson.dumps({"assets_ids": added, "operation": "subscribe"}).decode())
+    if removed:
+        await ws.send(orjson.dumps({"assets_ids": removed, "operation": "unsubscribe"}).decode())
+    subscribed.difference_update(removed)
+    subscribed.update(added)
+    if added or removed:
+        logger.info(
+            "Подписка на цены: +%d / -%d, всего %d токенов",
+            len(added), len(removed), len(subscribed),
+        )
 
-                should_trigger = False
-                if direction == ">=" and current_price >= target_price:
-                    should_trigger = True
-                elif direction == "<=" and current_price <= target_price:
-                    should_trigger = True
 
-                if should_trigger:
-                    target_cents = target_price * 100
-                    current_cents = current_price * 100
+async def _consume_feed(ws, subscribed: set[str], sem: asyncio.Semaphore):
+    """
+    Читаем market-канал; при изменении набора token_id правим подписку
+    на лету, не переподключаясь. Изменения цен копим WS_DEBOUNCE секунд
+    и проверяем одной пачкой.
+    """
+    loop = asyncio.get_running_loop()
+    dirty: set[str] = set()
+    deadline = None
+    next_ping = loop.time() + WS_PING_INTERVAL
 
-                    text = (
-                        f"Сработал алерт #{alert_id}!\n\n"
-                        f"Рынок: {market_url}\n"
-                        f"Исход: {outcome}\n"
-                        f"Целевая цена: {target_price:.4f} ({target_cents:.1f}c)\n"
-                        f"Текущая цена: {current_price:.4f} ({current_cents:.1f}c)\n"
-                    )
-                    try:
-                        await bot.send_message(user_id, text)
-                    except Exception as e:
-                        print(f"[alerts_worker] Ошибка отправки сообщения пользователю {user_id}: {e}")
+    while True:
+        if _watched_changed.is_set():
+            await _sync_subscription(ws, subscribed)
 
-                    deactivate_alert(user_id=user_id, alert_id=alert_id)
+        timeout = WS_DEBOUNCE if deadline is None else max(0.0, deadline - loop.time())
+        try:
+            raw = await asyncio.wait_for(ws.recv(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raw = None
+
+        if raw is not None:
+            changed = {token_id for token_id in _changed_assets(raw) if token_id in _watched}
+            if changed:
+                dirty |= changed
+                if deadline is None:
+                    deadline = loop.time() + WS_DEBOUNCE
+
+        now = loop.time()
+        if deadline is not None and now >= deadline:
+            await _recheck_tokens(dirty, sem)
+            dirty = set()
+            deadline = None
+        if now >= next_ping:
+            await ws.send("PING")
+            next_ping = now + WS_PING_INTERVAL
+
+
+async def price_feed_worker():
+    """
+    Подписка на market-канал CLOB по всем отслеживаемым token_id:
+    алерты проверяются сразу после изменения цены, а не раз в POLL_INTERVAL.
+    Набор токенов меняется сообщениями subscribe/unsubscribe в том же соединении;
+    переподключаемся только при обрыве.
+    """
+    sem = asyncio.Semaphore(WORKER_CONCURRENCY)
 
-            except Exception as e:
-                print(f"[alerts_worker] Ошибка при обработке алерта {alert_id}: {e}")
+    while True:
+        _watched_changed.clear()
+        token_ids = list(_watched)
+        if not token_ids:
+            await _watched_changed.wait()
+            continue
 
-        await asyncio.sleep(60)
+        try:
+            async with websockets.connect(WS_MARKET_URL, max_size=WS_MAX_MESSAGE_SIZE) as ws:
+                await ws.send(orjson.dumps({"assets_ids": token_ids, "type": "market"}).decode())
+                logger.info("Подписка на цены: %d токенов", len(token_ids))
+                await _consume_feed(ws, set(token_ids), sem)
+        except Exception as e:
+            logger.warning("Websocket market-канала оборвался: %s", e)
+            await asyncio.sleep(WS_RECONNECT_DELAY)
 
 
 # ---------- Точка входа ----------
 
 async def main():
-    init_db()
-    asyncio.create_task(alerts_worker())
-    await dp.start_polling(bot)
+    _log_listener.start()
+    try:
+        await asyncio.to_thread(init_db)
+        async with HTTP:
+            asyncio.create_task(alerts_worker())
+            asyncio.create_task(price_feed_worker())
+            await dp.start_polling(bot)
+    finally:
+        _log_listener.stop()
 
 
 if __name__ == "__main__":